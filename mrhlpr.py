@@ -4,7 +4,11 @@
 # PYTHON_ARGCOMPLETE_OK
 
 import sys
-import mrhlpr.frontend
+import mrhlpr.client
 
 if __name__ == "__main__":
-    sys.exit(mrhlpr.frontend.main())
+    ret = mrhlpr.client.run(sys.argv[1:])
+    if ret is None:
+        import mrhlpr.frontend
+        ret = mrhlpr.frontend.main()
+    sys.exit(ret)
@@ -0,0 +1,248 @@
+# Copyright 2020 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+""" In-process API: returns result objects instead of printing, and raises
+    MrhlprError instead of exiting. Example:
+
+    >>> from mrhlpr import api
+    >>> status = api.status(81)
+    >>> [check.name for check in status.checks if check.result is False]
+    ['Rebase on master', 'MR-ID in commit msgs'] """
+
+import contextlib
+import dataclasses
+import subprocess
+import typing
+import urllib.error
+
+from . import git
+from . import gitlab
+from . import mr
+from .error import MrhlprError
+
+
+@dataclasses.dataclass
+class Check:
+    """ One entry of the status checks.
+
+        result: True (OK), False (NOK) or None (unknown, e.g. if the MR is not
+                checked out)
+        details: list of strings explaining the result """
+    __slots__ = ("name", "result", "details")
+    name: str
+    result: typing.Optional[bool]
+    details: typing.List[str]
+
+
+@dataclasses.dataclass
+class Status:
+    """ Status of a merge request. Most checks are only possible, when the
+        branch is checked out locally.
+
+        state: "opened", "closed", "merged" or "locked"
+        commits: commit IDs on top of the target branch (if checked out)
+        push_status: see mr.get_push_status() (None if not checked out)
+        checklist: things to do next, in order to get the MR shipped """
+    __slots__ = ("mr_id", "url", "title", "state", "source",
+                 "source_namespace", "source_branch", "target_branch", "sha",
+                 "allow_push", "checked_out", "commits", "push_status",
+                 "checks", "checklist")
+    mr_id: int
+    url: str
+    title: str
+    state: str
+    source: str
+    source_namespace: str
+    source_branch: str
+    target_branch: str
+    sha: str
+    allow_push: bool
+    checked_out: bool
+    commits: typing.List[str]
+    push_status: typing.Optional[str]
+    checks: typing.List[Check]
+    checklist: typing.List[str]
+
+    def to_dict(self):
+        """ :returns: the status as dict, which can be serialized to JSON """
+        return dataclasses.asdict(self)
+
+
+@contextlib.contextmanager
+def errors_wrapped(mr_id):
+    """ Raise failed API requests, connection problems and git commands as
+        MrhlprError, so callers only need to handle one exception type. """
+    try:
+        yield
+    except urllib.error.HTTPError as e:
+        raise MrhlprError(f"MR {mr_id}: API request failed: {e}") from e
+    except OSError as e:
+        # Connection problems (URLError is a subclass as well)
+        raise MrhlprError(f"MR {mr_id}: {e}") from e
+    except subprocess.CalledProcessError as e:
+        output = e.output.decode("utf-8").rstrip() if e.output else ""
+        raise MrhlprError(f"MR {mr_id}: git command failed: "
+                          f"{' '.join(e.cmd)}\n{output}".rstrip()) from e
+
+
+def checked_out():
+    """ :returns: checked out MR ID or None """
+    return mr.checked_out()
+
+
+def _checklist(status, clean_worktree, is_rebased, commits_have_id,
+               commits_follow_format, commits_are_signed):
+    """ :returns: list of things to do next, in order to get the MR shipped """
+    ret = []
+    target_branch = status["target_branch"]
+    if not status["allow_push"]:
+        return ["Ask MR author to tick 'Allow commits from members who can"
+                " merge to the target branch.'",
+                "Check again ('mrhlpr -n status')"]
+
+    if not status["checked_out"]:
+        return ["Checkout this MR ('mrhlpr checkout " +
+                str(status["mr_id"]) + "')"]
+
+    if not clean_worktree:
+        return ["Commit or stash changes in your worktree",
+                "Check again ('mrhlpr status')"]
+
+    commits = status["commits"]
+    if len(commits) > 1:
+        ret += [f"{len(commits)} commits: consider squashing"
+                f" ('git rebase -i origin/{target_branch}')"]
+
+    if not is_rebased:
+        return ret + [f"Rebase on {target_branch} ('git"
+                      f" rebase origin/{target_branch}')",
+                      "Check again ('mrhlpr status')"]
+
+    if not commits_have_id or not commits_are_signed:
+        return ret + ["Add the MR-ID to all commits and sign them ('mrhlpr"
+                      " fixmsg')"]
+
+    if commits_follow_format is False:
+        return ret + ["Fix commit subjects that don't follow the correct"
+                      " formatting"]
+
+    if commits_follow_format is None:
+        ret += ["Manually check if the commit subjects are correct"]
+
+    origin = gitlab.parse_git_origin()
+    remote_local = status["source"].split("/", 1)[0]
+    if remote_local == origin["project"]:
+        remote_local = "origin"
+
+    push_status = status["push_status"]
+    if push_status == "remote-new":
+        return ret + ["The MR's branch has new commits, fetch and review them"
+                      f" ('git fetch {remote_local}')",
+                      "Check again ('mrhlpr status')"]
+
+    ret += ["Pretty 'git log -" + str(len(commits)) + " --pretty'?" +
+            " (consider copying MR desc)"]
+    if push_status != "up-to-date":
+        force = " --force" if push_status == "force-push" else ""
+        ret += [f"Push your changes ('git push{force} {remote_local} HEAD:"
+                f"{status['source_branch']}')"]
+    return ret + ["Web UI: comment about your reviewing and testing",
+                  "Web UI: approve MR",
+                  "Web UI: do (automatic) merge"]
+
+
+def status(mr_id, no_cache=False):
+    """ Get the status of a merge request, with all checks and the checklist.
+
+        :param mr_id: merge request ID
+        :param no_cache: do not cache the API result for the merge request data
+        :returns: Status """
+    if not mr_id:
+        raise MrhlprError("can't associate the current branch with a merge"
+                          " request ID. Run 'mrhlpr checkout N' first (N is"
+                          " the MR-ID).")
+
+    with errors_wrapped(mr_id):
+        return _status(mr_id, no_cache)
+
+
+def _status(mr_id, no_cache):
+    """ See status(). """
+    # Revalidate the MR data if checked out, so the push status is based on
+    # the MR's current sha (and the returned data matches it)
+    checked_out = mr.checked_out() == mr_id
+    ret = mr.get_status(mr_id, no_cache, checked_out)
+    ret["mr_id"] = mr_id
+    ret["checked_out"] = checked_out
+    ret["commits"] = []
+    ret["push_status"] = None
+    target_branch = ret["target_branch"]
+    is_rebased = None
+    clean_worktree = None
+    commits_have_id = None
+    commits_follow_format = None
+    subj_err = []
+    commits_are_signed = None
+
+    # Generate URL
+    origin = gitlab.parse_git_origin()
+    ret["url"] = "https://{}/{}/merge_requests/{}".format(
+        origin["host"], origin["project_id"], mr_id)
+
+    if ret["checked_out"]:
+        is_rebased = git.is_rebased(target_branch)
+        clean_worktree = git.clean_worktree()
+        commits = git.commits_on_top_of(target_branch)
+        commits_have_id = mr.commits_have_mr_id(commits, mr_id)
+        commits_follow_format, subj_err = mr.commits_follow_format(commits)
+        commits_are_signed = mr.commits_are_signed(commits)
+        ret["commits"] = commits
+        ret["push_status"] = mr.get_push_status(ret["sha"])
+
+    push_details = []
+    if ret["push_status"] == "push":
+        push_details = ["needs push"]
+    elif ret["push_status"] == "force-push":
+        push_details = ["needs force-push"]
+    elif ret["push_status"] == "remote-new":
+        push_details = ["remote has new commits"]
+
+    ret["checks"] = [
+        Check("Changes allowed", ret["allow_push"], []),
+        Check("Clean worktree", clean_worktree, []),
+        Check(f"Rebase on {target_branch}", is_rebased, []),
+        Check("MR-ID in commit msgs", commits_have_id, []),
+        Check("Commit subjects follow format", commits_follow_format,
+              subj_err),
+        Check("Commits are signed", commits_are_signed, []),
+        Check("Changes pushed",
+              None if ret["push_status"] is None
+              else ret["push_status"] == "up-to-date",
+              push_details)]
+
+    ret["checklist"] = []
+    if ret["state"] not in ["closed", "merged"]:
+        ret["checklist"] = _checklist(ret, clean_worktree, is_rebased,
+                                      commits_have_id, commits_follow_format,
+                                      commits_are_signed)
+    return Status(**ret)
+
+
+def checkout(mr_id, no_cache=False, fetch=False, overwrite_remote=False):
+    """ Checkout a merge request, see mr.checkout().
+
+        :returns: Status after the checkout """
+    with errors_wrapped(mr_id):
+        mr.checkout(mr_id, no_cache, fetch, overwrite_remote)
+    return status(mr_id)
+
+
+def fixmsg(mr_id=None):
+    """ Add the MR-ID to each commit of the MR and sign them, see
+        mr.fixmsg().
+
+        :param mr_id: merge request ID (default: the checked out one)
+        :returns: Status after the rewrite """
+    mr_id = mr_id or checked_out()
+    with errors_wrapped(mr_id):
+        mr.fixmsg(mr_id)
+    return status(mr_id)
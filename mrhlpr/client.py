@@ -0,0 +1,58 @@
+# Copyright 2020 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+""" Thin client for daemon.py. Imports as little as possible, so it starts
+    fast. """
+
+import json
+import os
+import socket
+import sys
+
+# Actions that the daemon serves, everything else runs in-process. Only
+# read-only actions that never prompt: git commands started by the daemon
+# would get its stdin and terminal, not the client's (e.g. for gpg passphrase,
+# credential or SSH prompts of checkout and fixmsg).
+actions = ["status"]
+
+
+def socket_path():
+    """ :returns: path to the Unix socket of the daemon """
+    return os.getenv("HOME") + "/.cache/mrhlpr/daemon.sock"
+
+
+def run(argv):
+    """ Let the daemon run a mrhlpr command line, if it is running.
+
+        :param argv: command line arguments (without the program name)
+        :returns: exit code, or None if the daemon is not running or does not
+                  serve the action (run it in-process then) """
+    if os.getenv("MRHLPR_NO_DAEMON"):
+        return None
+    action = next((arg for arg in argv if not arg.startswith("-")), None)
+    if action not in actions:
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path())
+    except OSError:
+        sock.close()
+        return None
+
+    with sock:
+        request = {"argv": argv, "cwd": os.getcwd(), "env": dict(os.environ)}
+        sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        for line in sock.makefile("r", encoding="utf-8"):
+            message = json.loads(line)
+            if "stdout" in message:
+                sys.stdout.write(message["stdout"])
+                sys.stdout.flush()
+            elif "stderr" in message:
+                sys.stderr.write(message["stderr"])
+                sys.stderr.flush()
+            elif "exit" in message:
+                return message["exit"]
+
+    print("ERROR: mrhlpr daemon closed the connection unexpectedly",
+          file=sys.stderr)
+    return 1
@@ -0,0 +1,114 @@
+# Copyright 2020 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+""" Optional resident process that runs mrhlpr commands for client.py.
+
+    Parsed origin remotes, cache files, mrdb, compiled .mrhlpr.json rules and
+    HTTPS connections stay in memory between requests. Requests are handled
+    one after another, because each one changes the working directory and
+    environment of the process to the client's.
+
+    Protocol (one JSON object per line): the client sends
+    {"argv": [...], "cwd": "...", "env": {...}}, the daemon answers with any
+    amount of {"stdout": "..."} and {"stderr": "..."}, then {"exit": N}. """
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import traceback
+
+from . import client
+from .error import MrhlprError
+
+
+class Forward:
+    """ File-like object that sends everything written to it to the client,
+        as stdout or stderr message. """
+
+    def __init__(self, wfile, key):
+        self.wfile = wfile
+        self.key = key
+
+    def write(self, text):
+        if text:
+            message = json.dumps({self.key: text}) + "\n"
+            self.wfile.write(message.encode("utf-8"))
+        return len(text)
+
+    def flush(self):
+        self.wfile.flush()
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """ Run one command line in the context of the client. """
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        logging.debug("daemon request: " + str(request["argv"]))
+
+        cwd = os.getcwd()
+        env = dict(os.environ)
+        stdout = sys.stdout
+        stderr = sys.stderr
+        try:
+            os.chdir(request["cwd"])
+            os.environ.clear()
+            os.environ.update(request["env"])
+            sys.stdout = Forward(self.wfile, "stdout")
+            sys.stderr = Forward(self.wfile, "stderr")
+            try:
+                ret = self.server.main(request["argv"])
+            except SystemExit as e:
+                # argparse exits on invalid arguments and --help
+                ret = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                traceback.print_exc()
+                ret = 1
+            sys.stdout.flush()
+            self.wfile.write((json.dumps({"exit": ret}) + "\n").encode())
+        finally:
+            sys.stdout = stdout
+            sys.stderr = stderr
+            os.environ.clear()
+            os.environ.update(env)
+            os.chdir(cwd)
+            logging.basicConfig(format="%(message)s", force=True,
+                                level=logging.getLogger().level)
+
+
+def serve(main):
+    """ Listen on the socket of client.socket_path() until interrupted.
+
+        :param main: function that runs one command line, like
+                     frontend.main() """
+    path = client.socket_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Remove the socket of a daemon that did not shut down properly
+    if os.path.exists(path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            raise MrhlprError("mrhlpr daemon is running already: " + path)
+        except ConnectionRefusedError:
+            os.remove(path)
+        finally:
+            sock.close()
+
+    umask = os.umask(0o077)
+    try:
+        server = socketserver.UnixStreamServer(path, Handler)
+    finally:
+        os.umask(umask)
+    server.main = main
+
+    logging.info("mrhlpr daemon listening on " + path)
+    try:
+        with server:
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.remove(path)
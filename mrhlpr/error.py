@@ -0,0 +1,9 @@
+# Copyright 2020 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+""" Exception raised by mrhlpr functions, instead of exiting. """
+
+
+class MrhlprError(Exception):
+    """ Something went wrong. The message explains what happened and how to
+        fix it, it may consist of multiple lines. """
+    pass
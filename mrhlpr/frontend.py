@@ -3,6 +3,7 @@
 """ Pretty outputs and such. """
 
 import argparse
+import json
 import logging
 
 try:
@@ -10,212 +11,195 @@ try:
 except ImportError:
     argcomplete = False
 
-from . import git
-from . import gitlab
+from . import api
+from . import daemon
 from . import mr
+from .error import MrhlprError
 
 
-def print_status(mr_id, no_cache=False):
+def print_status(status):
     """ Print the merge request status. Most info is only visible, when the
         branch is checked out locally. Always display a checklist of things to
         do next, in order to get the MR shipped.
 
-        :param mr_id: merge request ID
-        :param no_cache: do not cache the API result for the merge request data
-    """
-    if not mr_id:
-        print("ERROR: can't associate the current branch with a merge request"
-              " ID. Run 'mrhlpr checkout N' first (N is the MR-ID).")
-        exit(1)
-
-    status = mr.get_status(mr_id, no_cache)
-    is_checked_out = mr.checked_out() == mr_id
-    is_rebased = None
-    clean_worktree = None
-    commits = []
-    commits_have_id = None
-    commits_are_signed = None
-    target_branch = status["target_branch"]
-
-    # Generate URL
-    origin = gitlab.parse_git_origin()
-    url = "https://{}/{}/merge_requests/{}".format(origin["host"],
-                                                   origin["project_id"], mr_id)
-
+        :param status: return value of api.status()
+        :returns: exit code, 1 if the MR was closed or merged, 0 otherwise """
     # Header
-    print(url)
+    print(status.url)
     print()
-    print("\"" + status["title"] + "\"" + " (MR " + str(mr_id) + ")")
-    if is_checked_out:
-        is_rebased = git.is_rebased(target_branch)
-        clean_worktree = git.clean_worktree()
-        commits = git.commits_on_top_of(target_branch)
-        commits_have_id = mr.commits_have_mr_id(commits, mr_id)
-        commits_follow_format, subj_err = mr.commits_follow_format(commits)
-        commits_are_signed = mr.commits_are_signed(commits)
+    print("\"" + status.title + "\"" + " (MR " + str(status.mr_id) + ")")
+    if status.checked_out:
+        commits = status.commits
         print("{} commit{} from {}/{}".format(len(commits),
                                               "s" if len(commits) > 1 else "",
-                                              status["source_namespace"],
-                                              status["source_branch"]))
+                                              status.source_namespace,
+                                              status.source_branch))
     else:
-        print("not checked out, from " + status["source"])
+        print("not checked out, from " + status.source)
     print()
 
-    if status["state"] == "closed":
+    if status.state == "closed":
         print("ERROR: MR has been closed.")
-        exit(1)
-    elif status["state"] == "merged":
+        return 1
+    elif status.state == "merged":
         print("ERROR: MR has been merged.")
-        exit(1)
-
-    # Changes allowed by maintainers
-    if status["allow_push"]:
-        print("[OK ] Changes allowed")
-    else:
-        print("[NOK] Changes allowed")
-
-    # Clean worktree
-    if clean_worktree is None:
-        print("[???] Clean worktree")
-    elif clean_worktree:
-        print("[OK ] Clean worktree")
-    else:
-        print("[NOK] Clean worktree")
-
-    # Rebase on target branch
-    if is_rebased is None:
-        print(f"[???] Rebase on {target_branch}")
-    elif is_rebased:
-        print(f"[OK ] Rebase on {target_branch}")
-    else:
-        print(f"[NOK] Rebase on {target_branch}")
-
-    # MR-ID in all commit messages
-    if commits_have_id is None:
-        print("[???] MR-ID in commit msgs")
-    elif commits_have_id:
-        print("[OK ] MR-ID in commit msgs")
-    else:
-        print("[NOK] MR-ID in commit msgs")
-
-    # All commits follow formatting
-    if commits_follow_format is None:
-        print("[???] Commit subjects follow format")
-        for line in subj_err:
-            print("   " + line)
-    elif commits_follow_format:
-        print("[OK ] Commit subjects follow format")
-    else:
-        print("[NOK] Commit subjects follow format")
-        for line in subj_err:
+        return 1
+
+    # Checks
+    for check in status.checks:
+        if check.result is None:
+            print("[???] " + check.name)
+        elif check.result:
+            print("[OK ] " + check.name)
+        else:
+            print("[NOK] " + check.name)
+        for line in check.details:
             print("   " + line)
 
-    # Commits are signed
-    if commits_are_signed is None:
-        print("[???] Commits are signed")
-    elif commits_are_signed:
-        print("[OK ] Commits are signed")
-    else:
-        print("[NOK] Commits are signed")
-
     # Checklist
     print()
     print("Checklist:")
-    if not status["allow_push"]:
-        print("* Ask MR author to tick 'Allow commits from members who can"
-              " merge to the target branch.'")
-        print("* Check again ('mrhlpr -n status')")
-        return
-
-    if not is_checked_out:
-        print("* Checkout this MR ('mrhlpr checkout " + str(mr_id) + "')")
-        return
-
-    if not clean_worktree:
-        print("* Commit or stash changes in your worktree")
-        print("* Check again ('mrhlpr status')")
-        return
-
-    if len(commits) > 1:
-        print(f"* {len(commits)} commits: consider squashing"
-              f" ('git rebase -i origin/{target_branch}')")
-
-    if not is_rebased:
-        print(f"* Rebase on {target_branch} ('git"
-              f" rebase origin/{target_branch}')")
-        print("* Check again ('mrhlpr status')")
-        return
-
-    if not commits_have_id or not commits_are_signed:
-        print("* Add the MR-ID to all commits and sign them ('mrhlpr fixmsg')")
-        return
-
-    if commits_follow_format is False:
-        print("* Fix commit subjects that don't follow the correct formatting")
-        return
-
-    if commits_follow_format is None:
-        print("* Manually check if the commit subjects are correct")
-
-    origin = gitlab.parse_git_origin()
-    remote_local = status["source"].split("/", 1)[0]
-    if remote_local == origin["project"]:
-        remote_local = "origin"
-
-    print("* Pretty 'git log -" + str(len(commits)) + " --pretty'?" +
-          " (consider copying MR desc)")
-    print(f"* Push your changes ('git push --force {remote_local} HEAD:"
-          f"{status['source_branch']}')")
-    print("* Web UI: comment about your reviewing and testing")
-    print("* Web UI: approve MR")
-    print("* Web UI: do (automatic) merge")
-
-
-def parse_args():
+    for line in status.checklist:
+        print("* " + line)
+    return 0
+
+
+def print_json(obj):
+    """ Print an object as one line of JSON (NDJSON output). """
+    print(json.dumps(obj), flush=True)
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("-n", "--no-cache", action="store_true",
                         help="do not use local cache for MR information")
     parser.add_argument("-v", "--verbose", action="store_true",
                         help="display debug log: all git commands and"
                              " locations of http cache files")
+    parser.add_argument("-j", "--json", action="store_true",
+                        help="print results as one JSON object per line"
+                             " (NDJSON), messages go to stderr")
     sub = parser.add_subparsers(title="action", dest="action")
     sub.required = True
 
     # Status
     status = sub.add_parser("status", help="show the MR status")
-    status.add_argument("mr_id", type=int, nargs="?", help="merge request ID")
+    status.add_argument("mr_id", type=int, nargs="*",
+                        help="merge request IDs (default: checked out MR)")
 
     # Checkout
     checkout = sub.add_parser("checkout",
                               help="add and switch to the MR's branch")
     checkout.add_argument("-n", "--no-fetch", action="store_false",
-                          dest="fetch",
+                          dest="fetch", default=None,
                           help="do not fetch the remote and origin"
                                " repositories")
+    checkout.add_argument("-f", "--fetch", action="store_true",
+                          dest="fetch", default=None,
+                          help="fetch the remote and origin repositories,"
+                               " even if the MR was prefetched already")
     checkout.add_argument("-o", "--overwrite-remote", action="store_true",
                           help="overwrite the remote URLs if they differ")
+    checkout.add_argument("-p", "--prefetch", action="store_true",
+                          help="run 'mrhlpr prefetch' in the background"
+                               " afterwards")
     checkout.add_argument("mr_id", type=int, help="merge request ID")
 
     # Fixmsg
     sub.add_parser("fixmsg", help="add the MR-ID to all commits and sign them")
 
+    # Prefetch
+    sub.add_parser("prefetch", help="cache API data and fetch commits of all"
+                                    " open MRs, for faster checkouts later")
+
+    # Prune
+    prune = sub.add_parser("prune", help="delete branches, remotes and cached"
+                                         " IDs of merged and closed MRs")
+    prune.add_argument("-d", "--dry-run", action="store_true",
+                       help="only show what would be deleted")
+
+    # Daemon
+    sub.add_parser("daemon", help="keep running and serve status for faster"
+                                  " responses")
+
     if argcomplete:
         argcomplete.autocomplete(parser, always_complete_options="long")
-    return parser.parse_args()
-
-
-def main():
-    args = parse_args()
-    if args.verbose:
-        logging.getLogger().setLevel(logging.DEBUG)
-    if args.action == "status":
-        mr_id = args.mr_id if args.mr_id else mr.checked_out()
-        print_status(mr_id, args.no_cache)
-    elif args.action == "checkout":
-        mr.checkout(args.mr_id, args.no_cache, args.fetch,
-                    args.overwrite_remote)
-        print_status(args.mr_id)
-    elif args.action == "fixmsg":
-        mr_id = mr.checked_out()
-        mr.fixmsg(mr_id)
-        print_status(mr_id)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(format="%(message)s", force=True,
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    try:
+        if args.action == "status":
+            return status(args)
+        elif args.action == "checkout":
+            ret = api.checkout(args.mr_id, args.no_cache, args.fetch,
+                               args.overwrite_remote)
+            if args.prefetch:
+                mr.prefetch_background()
+        elif args.action == "fixmsg":
+            ret = api.fixmsg()
+        elif args.action == "prefetch":
+            mr_ids = mr.prefetch()
+            if args.json:
+                print_json({"prefetched": mr_ids})
+            else:
+                print("Prefetched " + str(len(mr_ids)) + " MRs")
+            return 0
+        elif args.action == "prune":
+            pruned = mr.prune(args.dry_run)
+            if args.json:
+                print_json(pruned)
+            else:
+                print("{}{} branches, {} remotes, {} refs, {} mrdb"
+                      " entries".format(
+                          "Would prune " if args.dry_run else "Pruned ",
+                          pruned["branches"], pruned["remotes"],
+                          pruned["refs"], pruned["mrdb"]))
+            return 0
+        elif args.action == "daemon":
+            daemon.serve(main)
+            return 0
+    except MrhlprError as e:
+        return print_error(args, e)
+
+    if args.json:
+        print_json(ret.to_dict())
+        return 0
+    return print_status(ret)
+
+
+def print_error(args, error, mr_id=None):
+    """ Print an error in the selected output format.
+
+        :returns: exit code (always 1) """
+    if args.json:
+        print_json({"mr_id": mr_id, "error": str(error)})
+    else:
+        print("ERROR: " + str(error))
+    return 1
+
+
+def status(args):
+    """ Print the status of all MRs passed as arguments, or of the one that is
+        checked out. Errors of one MR don't stop the others from being
+        printed.
+
+        :returns: exit code """
+    mr_ids = args.mr_id or [mr.checked_out()]
+    ret = 0
+    for i, mr_id in enumerate(mr_ids):
+        if i and not args.json:
+            print()
+        try:
+            result = api.status(mr_id, args.no_cache)
+        except MrhlprError as e:
+            ret = print_error(args, e, mr_id)
+            continue
+        if args.json:
+            print_json(result.to_dict())
+        elif print_status(result):
+            ret = 1
+    return ret
@@ -6,19 +6,23 @@ import subprocess
 import logging
 
 
-def run(parameters, env=None, check=True):
+def run(parameters, env=None, check=True, stdin=None, cwd=None):
     """ Run a git command.
 
         :param parameters: list of arguments to pass to git
         :param env: environment variables passed to the process
+        :param stdin: string to pass to the process as standard input
         :param check: when set to True, raise an exception on exit code not
                       being 0
+        :param cwd: directory to run the command in (default: current one)
         :returns: on success: output of the command (last new line removed)
                   on failure: None """
     try:
         logging.debug("+ git " + " ".join(parameters))
+        stdin = stdin.encode("utf-8") if stdin is not None else None
         stdout = subprocess.check_output(["git"] + parameters, env=env,
-                                         stderr=subprocess.STDOUT)
+                                         stderr=subprocess.STDOUT,
+                                         input=stdin, cwd=cwd)
         ret = stdout.decode("utf-8").rstrip()
         logging.debug(ret)
         return ret
@@ -30,6 +34,28 @@ def run(parameters, env=None, check=True):
         return None
 
 
+def run_first_line(parameters):
+    """ Run a git command and stop it as soon as it printed the first line.
+
+        :param parameters: list of arguments to pass to git
+        :returns: the first line of the output (new line removed), or None if
+                  the command did not print anything
+        :raises CalledProcessError: if the command failed without printing
+                                    anything """
+    logging.debug("+ git " + " ".join(parameters))
+    with subprocess.Popen(["git"] + parameters, stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL) as proc:
+        line = proc.stdout.readline()
+        if line:
+            proc.terminate()
+    if not line and proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode,
+                                            ["git"] + parameters)
+    ret = line.decode("utf-8").rstrip() if line else None
+    logging.debug(ret)
+    return ret
+
+
 def get_remote_url(remote="origin"):
     """ :returns: the remote URL as string, e.g.
                   "https://gitlab.com/postmarketOS/pmaports.git" """
@@ -42,6 +68,43 @@ def branches(obj="refs/heads"):
     return ret.splitlines()
 
 
+def branch_remotes(obj="refs/heads"):
+    """ :returns: dict of all local branch names and their upstream remote
+                  names (or None, if the branch has no upstream) """
+    ret = {}
+    out = run(["for-each-ref", obj, "--format",
+               "%(refname:short) %(upstream:remotename)"])
+    for line in out.splitlines():
+        branch, remote = (line + " ").split(" ", 1)
+        ret[branch] = remote.strip() or None
+    return ret
+
+
+def branches_checked_out():
+    """ :returns: set of branch names that are checked out in any worktree of
+                  the repository (including the current one) """
+    ret = set()
+    for line in run(["worktree", "list", "--porcelain"]).splitlines():
+        if line.startswith("branch refs/heads/"):
+            ret.add(line[len("branch refs/heads/"):])
+    return ret
+
+
+def remotes():
+    """ :returns: a list of all configured remote names """
+    return run(["remote"]).splitlines()
+
+
+def update_refs(commands):
+    """ Run multiple ref updates in one git process, as transaction.
+
+        :param commands: list of "git update-ref --stdin" commands, e.g.
+                         ["delete refs/heads/mrhlpr/81"] """
+    if not commands:
+        return
+    run(["update-ref", "--stdin"], stdin="\n".join(commands) + "\n")
+
+
 def branch_current():
     """ :returns: current branch name (if any) or "HEAD" """
     return run(["rev-parse", "--abbrev-ref", "HEAD"])
@@ -61,14 +124,65 @@ def commits_on_top_of(branch_name="master"):
     return run(["rev-list", f"origin/{branch_name}..HEAD"]).splitlines()
 
 
+def objects_missing(object_ids):
+    """ :param object_ids: list of object ID strings
+        :returns: list of the given object IDs that are not available in the
+                  local repository """
+    if not object_ids:
+        return []
+    out = run(["cat-file", "--batch-check"],
+              stdin="\n".join(object_ids) + "\n")
+    return [line.split(" ", 1)[0] for line in out.splitlines()
+            if line.endswith(" missing")]
+
+
+def is_ancestor(ancestor, descendant="HEAD"):
+    """ :returns: True if commit ancestor is in the history of descendant """
+    return run(["merge-base", "--is-ancestor", ancestor, descendant],
+               check=False) is not None
+
+
 def is_rebased(branch_name="master"):
     """ Check if the current branch needs to be rebased on a given branch. """
     return run(["rev-list", "--count", f"HEAD..origin/{branch_name}"]) == "0"
 
 
+# Values that git accepts as false for boolean config options
+config_false = ["false", "no", "off", "0"]
+
+
+def config_enabled(key):
+    """ :returns: True if a git config option is set to anything but a false
+                  boolean value """
+    value = run(["config", "--get", key], check=False)
+    return bool(value) and value.lower() not in config_false
+
+
 def clean_worktree():
-    """ Check if there are not modified files in the git dir. """
-    return run(["status", "--porcelain"]) == ""
+    """ Check if there are not modified files in the git dir. Tracked files
+        are checked first, which is cheap (and uses fsmonitor if configured)
+        and stops at the first change. Only then untracked files get
+        scanned. """
+    # Changes between worktree and index, and between index and HEAD
+    if run(["diff", "--quiet"], check=False) is None:
+        return False
+    if run(["diff", "--cached", "--quiet"], check=False) is None:
+        return False
+
+    # Untracked files: skip them if git status is configured to do so
+    show_untracked = run(["config", "--get", "status.showUntrackedFiles"],
+                         check=False)
+    if show_untracked and show_untracked.lower() in config_false:
+        return True
+
+    # git status makes use of the untracked cache and fsmonitor if
+    # configured, otherwise stop listing at the first file
+    if (config_enabled("core.untrackedCache") or
+            config_enabled("core.fsmonitor")):
+        return run(["status", "--porcelain"]) == ""
+    return run_first_line(["ls-files", "--others", "--exclude-standard",
+                           "--directory", "--no-empty-directory", "--",
+                           ":/"]) is None
 
 
 def topdir():
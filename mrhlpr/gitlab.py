@@ -2,58 +2,189 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 """ GitLab related functions on top of git. """
 
+import fcntl
 import hashlib
+import http.client
+import urllib.error
 import urllib.parse
 import urllib.request
 import os
-import shutil
 import json
 import logging
 import re
+import tempfile
+import time
 
 from . import git
+from .error import MrhlprError
 
+# Kept in memory, so a long running mrhlpr process (see daemon.py) does not
+# need to parse the origin remote, the cache files and establish a new HTTPS
+# connection again for each request
+config_paths = {}
+origins = {}
+parsed_cache_files = {}
+connections = {}
 
-def download_json(pathname, no_cache=False):
+
+def write_atomic(path, content):
+    """ Write a file through a unique temp file in the same directory, which
+        then replaces the target file atomically. """
+    fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp",
+                                     prefix=os.path.basename(path) + ".")
+    try:
+        with os.fdopen(fd, "w") as handle:
+            handle.write(content)
+        os.replace(temp_file, path)
+    except BaseException:
+        os.remove(temp_file)
+        raise
+
+
+def http_get(url, headers):
+    """ Send a GET request, over a persistent connection to the host unless
+        a proxy is configured.
+
+        :param url: full https URL
+        :param headers: dict of request headers
+        :returns: (status, response headers, body) of the response, after
+                  following redirects """
+    if urllib.request.getproxies().get("https"):
+        try:
+            request = urllib.request.Request(url, headers=headers)
+            with urllib.request.urlopen(request) as response:
+                return (response.status, response.headers, response.read())
+        except urllib.error.HTTPError as e:
+            return (e.code, e.headers, e.read())
+
+    # Follow redirects, like urlopen() does
+    for _ in range(10):
+        status, response_headers, body = http_get_persistent(url, headers)
+        if status not in [301, 302, 303, 307, 308]:
+            break
+        url = urllib.parse.urljoin(url, response_headers["Location"])
+        logging.debug("Redirected to " + url)
+    return (status, response_headers, body)
+
+
+def http_get_persistent(url, headers):
+    """ Send a GET request over a persistent connection to the host, without
+        following redirects.
+
+        :returns: (status, response headers, body) """
+    split = urllib.parse.urlsplit(url)
+    path = split.path + ("?" + split.query if split.query else "")
+    key = (split.scheme, split.netloc)
+    for retry in [False, True]:
+        if key not in connections:
+            if split.scheme == "http":
+                connections[key] = http.client.HTTPConnection(
+                    split.netloc, timeout=60)
+            else:
+                connections[key] = http.client.HTTPSConnection(
+                    split.netloc, timeout=60)
+        connection = connections[key]
+        try:
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            return (response.status, response.headers, response.read())
+        except (http.client.HTTPException, OSError):
+            # The server may have closed the connection since the last
+            # request, try once more with a new one
+            connection.close()
+            del connections[key]
+            if retry:
+                raise
+
+
+def download_json(pathname, no_cache=False, revalidate=False):
     """ Download and parse JSON from an API, with a cache.
 
         :param pathname: gitlab URL pathname (without the usual prefix)
         :param no_cache: download again, even if already cached
-        :returns: parsed JSON """
+        :param revalidate: ask the server if the cached version is still
+                           up-to-date (with its ETag), download again if not
+        :returns: parsed JSON (shared with later calls, don't modify it) """
     url = parse_git_origin()["api"] + pathname
 
     # Prepare cache
     cache_dir = os.getenv("HOME") + "/.cache/mrhlpr/http"
     cache_key = hashlib.sha256(url.encode("utf-8")).hexdigest()
     cache_file = cache_dir + "/" + cache_key
+    etag_file = cache_file + ".etag"
     os.makedirs(cache_dir, exist_ok=True)
+    started = time.time()
 
-    # Check the cache
-    if os.path.exists(cache_file) and not no_cache:
-        logging.debug("Download " + url + " (cached)")
-    else:
-        print("Download " + url)
-        # Save to temp file
-        temp_file = cache_file + ".tmp"
-        with urllib.request.urlopen(url) as response:
-            with open(temp_file, "wb") as handle:
-                shutil.copyfileobj(response, handle)
-
-        # Pretty print JSON (easier debugging)
-        with open(temp_file, "r") as handle:
-            parsed = json.load(handle)
-        with open(temp_file, "w") as handle:
-            handle.write(json.dumps(parsed, indent=4))
-
-        # Replace cache file
-        if os.path.exists(cache_file):
-            os.remove(cache_file)
-        os.rename(temp_file, cache_file)
-
-    # Parse JSON from the cache file
+    # Only one mrhlpr process downloads the same URL at a time, others wait
+    # for it and use its result (unless it was downloaded before they
+    # started and no_cache or revalidate is set)
+    with open(cache_file + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        # Check the cache
+        cached = os.path.exists(cache_file)
+        if cached and (not (no_cache or revalidate) or
+                       os.path.getmtime(cache_file) >= started):
+            logging.debug("Download " + url + " (cached)")
+        else:
+            headers = {}
+            if cached and os.path.exists(etag_file):
+                with open(etag_file, "r") as handle:
+                    headers["If-None-Match"] = handle.read()
+            status, response_headers, body = http_get(url, headers)
+            if status == 304:
+                logging.debug("Download " + url + " (not modified)")
+                os.utime(cache_file)
+                parsed = None
+            elif status == 200:
+                logging.info("Download " + url)
+                parsed = json.loads(body)
+                etag = response_headers.get("ETag")
+            else:
+                raise urllib.error.HTTPError(
+                    url, status, http.client.responses.get(status, ""),
+                    response_headers, None)
+
+            # Write pretty printed JSON (easier debugging) to a temp file,
+            # then replace the cache file atomically, so readers never see a
+            # partially written file
+            if parsed is not None:
+                write_atomic(cache_file, json.dumps(parsed, indent=4))
+                if etag:
+                    write_atomic(etag_file, etag)
+                elif os.path.exists(etag_file):
+                    os.remove(etag_file)
+
+    # Parse JSON from the cache file (unless it was parsed already and did
+    # not change since then)
     logging.debug(" -> " + cache_file)
-    with open(cache_file, "r") as handle:
-        return json.load(handle)
+    stat = os.stat(cache_file)
+    key = (stat.st_mtime_ns, stat.st_size)
+    if parsed_cache_files.get(cache_file, (None,))[0] != key:
+        with open(cache_file, "r") as handle:
+            parsed_cache_files[cache_file] = (key, json.load(handle))
+    return parsed_cache_files[cache_file][1]
+
+
+def download_json_pages(pathname, no_cache=False, revalidate=False,
+                        per_page=100):
+    """ Download all pages of a paginated API list, with a cache.
+
+        :param pathname: gitlab URL pathname (without the usual prefix)
+        :param no_cache: download again, even if already cached
+        :param revalidate: see download_json()
+        :param per_page: amount of items per page (GitLab allows up to 100)
+        :returns: list of all items from all pages """
+    ret = []
+    separator = "&" if "?" in pathname else "?"
+    page = 1
+    while True:
+        items = download_json(f"{pathname}{separator}per_page={per_page}"
+                              f"&page={page}", no_cache, revalidate)
+        ret += items
+        if len(items) < per_page:
+            return ret
+        page += 1
 
 
 def parse_git_origin():
@@ -66,11 +197,33 @@ def parse_git_origin():
                    "project": "postmarketOS",
                    "project_id": "postmarketOS/mrhlpr",
                    "host": "gitlab.com"} """
+    # Parse only once per directory, and again when the git config (with the
+    # remote URLs) changes
+    cwd = os.getcwd()
+    if cwd not in config_paths:
+        config_path = git.run(["rev-parse", "--git-path", "config"],
+                              check=False)
+        if not config_path:
+            return parse_git_origin_url()
+        config_paths[cwd] = os.path.abspath(config_path)
+    try:
+        stat = os.stat(config_paths[cwd])
+    except FileNotFoundError:
+        del config_paths[cwd]
+        return parse_git_origin_url()
+    key = (stat.st_mtime_ns, stat.st_size)
+    if origins.get(cwd, (None,))[0] != key:
+        origins[cwd] = (key, parse_git_origin_url())
+    return dict(origins[cwd][1])
+
+
+def parse_git_origin_url():
+    """ Parse the origin remote's URL, see parse_git_origin(). """
     # Try to get the URL
     url = git.get_remote_url()
     if not url:
-        print("Not inside a git repository, or no 'origin' remote configured.")
-        exit(1)
+        raise MrhlprError("Not inside a git repository, or no 'origin' remote"
+                          " configured.")
 
     # Find the host (gitlab.com only so far)
     prefixes = [r"^git@gitlab.com:",
@@ -82,8 +235,7 @@ def parse_git_origin():
             host = "gitlab.com"
             rest = re.sub(prefix, "", url)
     if not host:
-        print("Failed to extract gitlab server from: " + url)
-        exit(1)
+        raise MrhlprError("Failed to extract gitlab server from: " + url)
 
     # project_id: remove ".git" suffix
     project_id = rest
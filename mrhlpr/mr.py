@@ -8,10 +8,16 @@ import os
 import re
 import subprocess
 import sys
+import urllib.error
 
 from . import git
 from . import gitlab
 from . import mrdb
+from . import shared
+from .error import MrhlprError
+
+# Compiled regexes from .mrhlpr.json files, see load_definitions()
+definitions_cache = {}
 
 
 def checked_out():
@@ -21,13 +27,15 @@ def checked_out():
     return mrdb.get(origin["host"], origin["project_id"], branch)
 
 
-def get_status(mr_id, no_cache=False):
+def get_status(mr_id, no_cache=False, revalidate=False):
     """ Get merge request related information from the GitLab API.
         To hack on this, run mrhlpr with -v to get the cached JSON files
         location. Then you can take a look at the data returned from the API.
 
         :param mr_id: merge request ID
         :param no_cache: do not cache the API result for the merge request data
+        :param revalidate: ask the API if the cached merge request data is
+                           still up-to-date (see gitlab.download_json())
         :returns: a dict like:
                   {"title": "This is my first merge request",
                    "source_branch": "mymr",
@@ -35,13 +43,14 @@ def get_status(mr_id, no_cache=False):
                    "source": "ollieparanoid/mrhlpr",
                    "source_namespace": "ollieparanoid",
                    "allow_push": True,
-                   "state": "merged"} """
+                   "state": "merged",
+                   "sha": "0f2c5b2c4fc7f4c5a1e3a6f0d2e9c7b1a8d3e4f5"} """
     # Query merge request
     # https://docs.gitlab.com/ee/api/merge_requests.html
     origin = gitlab.parse_git_origin()
     url_mr = "/projects/{}/merge_requests/{}".format(origin["api_project_id"],
                                                      mr_id)
-    api = gitlab.download_json(url_mr, no_cache)
+    api = gitlab.download_json(url_mr, no_cache, revalidate)
 
     # Query source project/repository
     # https://docs.gitlab.com/ee/api/projects.html
@@ -63,22 +72,19 @@ def get_status(mr_id, no_cache=False):
     source = api_source["path_with_namespace"]
     if (not re.compile(r"[a-zA-Z0-9_.-]*\/[a-zA-Z0-9_.-]*").match(source) or
             source.startswith("-")):
-        print("Invalid source: " + source)
-        exit(1)
+        raise MrhlprError("Invalid source: " + source)
 
     source_namespace = api_source["namespace"]["name"]
     if (not re.compile(r"[a-zA-Z0-9_.-]*").match(source_namespace) or
             source_namespace.startswith("-")):
-        print("Invalid source_namespace: " + source_namespace)
-        exit(1)
+        raise MrhlprError("Invalid source_namespace: " + source_namespace)
 
     source_branch = api["source_branch"]
     target_branch = api["target_branch"]
     for branch in [source_branch, target_branch]:
         if (not re.compile(r"[a-zA-Z0-9/-_.]*").match(branch) or
                 branch.startswith("-")):
-            print(f"Invalid branch: {branch}")
-            exit(1)
+            raise MrhlprError(f"Invalid branch: {branch}")
 
     return {"title": api["title"],
             "source_branch": source_branch,
@@ -86,7 +92,13 @@ def get_status(mr_id, no_cache=False):
             "source": source,
             "source_namespace": source_namespace,
             "allow_push": allow_push,
-            "state": api["state"]}
+            "state": api["state"],
+            "sha": api["sha"]}
+
+
+def ref_prefetch(mr_id):
+    """ :returns: the hidden ref that 'mrhlpr prefetch' fetches a MR into """
+    return "refs/mrhlpr/prefetch/" + str(mr_id)
 
 
 def checkout(mr_id, no_cache=False, fetch=False, overwrite_remote=False):
@@ -95,18 +107,27 @@ def checkout(mr_id, no_cache=False, fetch=False, overwrite_remote=False):
 
         :param mr_id: merge request ID
         :param no_cache: do not cache the API result for the merge request data
-        :param fetch: always fetch the source repository
+        :param fetch: True: always fetch the source repository
+                      False: only fetch if the remote was added
+                      None: fetch, unless the MR was prefetched already
         :param overwrite_remote: overwrite URLs of existing remote """
-    status = get_status(mr_id, no_cache)
+    # Objects and origin may have been fetched already with 'mrhlpr prefetch'
+    # (don't use them if fetching was requested explicitly). Revalidate the
+    # API result in that case: prefetch cached it, so it may be outdated.
+    rev_prefetch = None
+    if fetch is not True:
+        rev_prefetch = git.run(["rev-parse", "-q", "--verify",
+                                ref_prefetch(mr_id)], check=False)
+    status = get_status(mr_id, no_cache, bool(rev_prefetch))
     remote, repo = status["source"].split("/", 1)
     origin = gitlab.parse_git_origin()
     branch = status["source_branch"]
 
     # Require clean worktree
     if not git.clean_worktree():
-        print("ERROR: worktree is not clean! Commit or stash your changes")
-        print("and try again. See 'git status' for details.")
-        exit(1)
+        raise MrhlprError("worktree is not clean! Commit or stash your"
+                          " changes\nand try again. See 'git status' for"
+                          " details.")
 
     # Don't add the origin remote twice
     remote_local = remote
@@ -121,86 +142,103 @@ def checkout(mr_id, no_cache=False, fetch=False, overwrite_remote=False):
     existing = git.get_remote_url(remote_local)
     if existing and existing != url:
         if overwrite_remote:
-            print("Overwriting remote URL (old: '" + existing + "')")
+            logging.info("Overwriting remote URL (old: '" + existing + "')")
             git.run(["remote", "set-url", remote_local, url])
             git.run(["remote", "set-url", "--push", remote_local, url_push])
         else:
-            print("ERROR: Remote '" + remote_local + "' already exists and has"
-                  " a different URL.")
-            print()
-            print("existing: " + existing)
-            print("expected: " + url)
-            print()
-            print("If you are fine with the expected url, use 'mrhlpr checkout"
-                  " " + str(mr_id) + " -o' to overwrite it.")
-            print()
-            print("mrhlpr will also set this pushurl: " + url_push)
-            exit(1)
+            raise MrhlprError("Remote '" + remote_local + "' already exists"
+                              " and has a different URL.\n"
+                              "\n"
+                              "existing: " + existing + "\n"
+                              "expected: " + url + "\n"
+                              "\n"
+                              "If you are fine with the expected url, use"
+                              " 'mrhlpr checkout " + str(mr_id) + " -o' to"
+                              " overwrite it.\n"
+                              "\n"
+                              "mrhlpr will also set this pushurl: " +
+                              url_push)
+
+    # Fall back to fetching normally if the MR changed since prefetching
+    prefetched = bool(rev_prefetch) and rev_prefetch == status["sha"]
+    if fetch is None:
+        fetch = not prefetched
 
     # Fetch origin
     if fetch and remote != origin["project"]:
-        print("Fetch " + git.get_remote_url())
+        logging.info("Fetch " + git.get_remote_url())
         git.run(["fetch", "origin"])
 
     # Add missing remote
     if not existing:
         git.run(["remote", "add", remote_local, url])
         git.run(["remote", "set-url", "--push", remote_local, url_push])
-        fetch = True
-    if fetch:
-        print("Fetch " + url)
+        fetch = not prefetched
+    if prefetched:
+        logging.info("Using prefetched " + url + " (" + branch + ")")
+        git.run(["update-ref", "refs/remotes/" + remote_local + "/" + branch,
+                 rev_prefetch])
+    elif fetch:
         try:
-            git.run(["fetch", remote_local])
+            if shared.enabled():
+                shared.fetch(url, status["source"], branch, remote_local,
+                             origin["project_id"], status["target_branch"])
+            else:
+                logging.info("Fetch " + url)
+                git.run(["fetch", remote_local])
         except subprocess.CalledProcessError:
-            print("Failed to fetch from remote. Try running 'git fetch " +
-                  remote_local + "' manually and check the output, most"
-                  " likely you ran into this problem:"
-                  " https://gitlab.com/postmarketOS/mrhlpr/issues/1")
-            sys.exit(1)
+            raise MrhlprError("Failed to fetch from remote. Try running 'git"
+                              " fetch " + remote_local + "' manually and"
+                              " check the output, most likely you ran into"
+                              " this problem:"
+                              " https://gitlab.com/postmarketOS/mrhlpr/"
+                              "issues/1")
 
     branch_local = "mrhlpr/" + str(mr_id)
 
     # Checkout the branch
-    print("Checkout " + branch_local + " from " + remote + "/" + branch)
+    logging.info("Checkout " + branch_local + " from " + remote + "/" + branch)
     if branch_local in git.branches():
         # Check existing branch
         remote_existing = git.branch_remote(branch_local)
         if remote_existing != remote_local:
-            print("Branch '" + branch_local + "' exists, but points to a"
-                  " different remote.")
-            print()
-            print("existing remote: " + str(remote_existing))
-            print("expected remote: " + remote_local)
-            print()
-            print("Consider deleting this branch and trying again:")
-            print("$ git checkout master")
-            print("$ git branch -D " + branch_local)
-            print("$ mrhlpr checkout " + str(mr_id) + " -n")
-            exit(1)
+            raise MrhlprError("Branch '" + branch_local + "' exists, but"
+                              " points to a different remote.\n"
+                              "\n"
+                              "existing remote: " + str(remote_existing) +
+                              "\n"
+                              "expected remote: " + remote_local + "\n"
+                              "\n"
+                              "Consider deleting this branch and trying"
+                              " again:\n"
+                              "$ git checkout master\n"
+                              "$ git branch -D " + branch_local + "\n"
+                              "$ mrhlpr checkout " + str(mr_id) + " -n")
         git.run(["checkout", branch_local])
 
         # Compare revisions (reset hard if needed)
         rev_current = git.run(["rev-parse", "HEAD"])
         rev_remote = git.run(["rev-parse", remote_local + "/" + branch])
         if rev_current == rev_remote:
-            print("(Most recent commit is already checked out.)")
+            logging.info("(Most recent commit is already checked out.)")
         else:
-            print("################")
-            print("NOTE: branch " + branch_local + " already exists, reusing.")
-            print("You can go back to the previous commit with:")
-            print("$ git reset --hard " + rev_current)
-            print("################")
+            logging.info("################\n"
+                         "NOTE: branch " + branch_local + " already exists,"
+                         " reusing.\n"
+                         "You can go back to the previous commit with:\n"
+                         "$ git reset --hard " + rev_current + "\n"
+                         "################")
             git.run(["reset", "--hard", rev_remote])
     else:
         git.run(["checkout", "-b", branch_local, remote_local + "/" + branch],
                 check=False)
         if git.branch_current() != branch_local:
-            print()
-            print("ERROR: checkout failed.")
-            print("* Does that branch still exist?")
-            print("* Maybe the MR has been closed/merged already?")
-            print("* Do you have unstaged commits that would be overwritten?")
-            exit(1)
+            raise MrhlprError("checkout failed.\n"
+                              "* Does that branch still exist?\n"
+                              "* Maybe the MR has been closed/merged"
+                              " already?\n"
+                              "* Do you have unstaged commits that would be"
+                              " overwritten?")
 
     # Set upstream branch (git will still complain with "The upstream branch
     # of your current branch does not match the name of your current branch",
@@ -212,6 +250,32 @@ def checkout(mr_id, no_cache=False, fetch=False, overwrite_remote=False):
     mrdb.set(origin["host"], origin["project_id"], branch_local, mr_id)
 
 
+def get_push_status(sha):
+    """ Compare the local branch with the MR's branch on GitLab, without
+        fetching anything with git.
+
+        :param sha: the MR's latest commit, from get_status() with revalidate
+                    set, so it is up-to-date
+        :returns: "up-to-date": local branch is the same as the MR's branch
+                  "push": local branch has new commits on top of the MR's
+                  "force-push": local branch has different commits (e.g. after
+                                rebasing, or 'mrhlpr fixmsg')
+                  "remote-new": the MR's branch has commits that are not in
+                                the local branch """
+    if git.run(["rev-parse", "HEAD"]) == sha:
+        return "up-to-date"
+
+    # Decide by ancestry: the MR's commits may be in the local repository
+    # (e.g. after 'mrhlpr prefetch'), without being in the local branch
+    if git.objects_missing([sha]):
+        return "remote-new"
+    if git.is_ancestor(sha, "HEAD"):
+        return "push"
+    if git.is_ancestor("HEAD", sha):
+        return "remote-new"
+    return "force-push"
+
+
 def commits_have_mr_id(commits, mr_id):
     """ Check if all given commits have the MR-ID in the subject.
 
@@ -224,6 +288,33 @@ def commits_have_mr_id(commits, mr_id):
     return True
 
 
+def load_definitions(definition_file):
+    """ Load and compile the subject format regexes of a .mrhlpr.json file.
+        The result is cached until the file changes (relevant for daemon.py).
+
+        :returns: (regexes_pass, regexes_unknown) """
+    stat = os.stat(definition_file)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = definitions_cache.get(definition_file)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    with open(definition_file) as handle:
+        definitions = json.load(handle)
+
+    regexes_pass = []
+    for regex in definitions['subject_format']['pass']:
+        regexes_pass.append(re.compile(regex))
+
+    regexes_unknown = []
+    for regex in definitions['subject_format']['unknown']:
+        regexes_unknown.append(re.compile(regex))
+
+    ret = (regexes_pass, regexes_unknown)
+    definitions_cache[definition_file] = (key, ret)
+    return ret
+
+
 def commits_follow_format(commits):
     """ Check if the commit subjects follow the correct naming format.
 
@@ -250,16 +341,7 @@ def commits_follow_format(commits):
     if not os.path.isfile(definition_file):
         return (True, [])
 
-    with open(definition_file) as handle:
-        definitions = json.load(handle)
-
-    regexes_pass = []
-    for regex in definitions['subject_format']['pass']:
-        regexes_pass.append(re.compile(regex))
-
-    regexes_unknown = []
-    for regex in definitions['subject_format']['unknown']:
-        regexes_unknown.append(re.compile(regex))
+    regexes_pass, regexes_unknown = load_definitions(definition_file)
 
     result = True
     subj_err = []
@@ -301,24 +383,157 @@ def fixmsg(mr_id):
 
         :param mr_id: merge request ID """
     if not mr_id:
-        print("ERROR: no merge request is currently checked out.")
-        print("Run 'mrhlpr checkout N' first.")
-        exit(1)
+        raise MrhlprError("no merge request is currently checked out.\n"
+                          "Run 'mrhlpr checkout N' first.")
     target_branch = get_status(mr_id)["target_branch"]
 
     script = os.path.realpath(os.path.realpath(__file__) +
                               "/../data/msg_filter.py")
-    os.chdir(git.run(["rev-parse", "--show-toplevel"]))
+    toplevel = git.run(["rev-parse", "--show-toplevel"])
 
-    print("Appending ' (MR " + str(mr_id) + ")' to commits and signing them...")  # noqa: E501
+    logging.info("Appending ' (MR " + str(mr_id) + ")' to commits and"
+                 " signing them...")
     try:
         env = os.environ.copy()
         env["MRHLPR_MSG_FILTER_MR_ID"] = str(mr_id)
         env["FILTER_BRANCH_SQUELCH_WARNING"] = "1"
         git.run(["filter-branch", "-f", "--msg-filter", script,
                  "--commit-filter", "git commit-tree -S \"$@\"",
-                 f"origin/{target_branch}..HEAD"], env=env)
+                 f"origin/{target_branch}..HEAD"], env=env, cwd=toplevel)
     except subprocess.CalledProcessError:
-        print("ERROR: git filter-branch failed. Do you have git commit signing"
-              " set up properly? (Run with -v to see the failing command.)")
-        exit(1)
+        raise MrhlprError("git filter-branch failed. Do you have git commit"
+                          " signing set up properly? (Run with -v to see the"
+                          " failing command.)")
+
+
+def prune(dry_run=False):
+    """ Delete local mrhlpr/<id> branches of merged, closed and deleted MRs,
+        the remotes that only they were using and their mrdb entries. The API
+        results get revalidated, so they are always up-to-date.
+
+        :param dry_run: only log what would be deleted
+        :returns: dict with the amount of pruned items, like:
+                  {"branches": 3, "remotes": 2, "refs": 145, "mrdb": 3} """
+    origin = gitlab.parse_git_origin()
+    branch_remotes = git.branch_remotes()
+    checked_out = git.branches_checked_out()
+
+    # Find branches of MRs that are not open anymore. Only look at the MRs
+    # that are not in the list of open MRs in detail.
+    url_mrs = "/projects/{}/merge_requests".format(origin["api_project_id"])
+    mr_ids_open = [api_mr["iid"] for api_mr in gitlab.download_json_pages(
+                   url_mrs + "?state=opened", revalidate=True)]
+    branches_stale = []
+    for branch in branch_remotes.keys():
+        match = re.match(r"^mrhlpr/([0-9]+)$", branch)
+        if not match or int(match.group(1)) in mr_ids_open:
+            continue
+        try:
+            state = gitlab.download_json(url_mrs + "/" + match.group(1),
+                                         revalidate=True)["state"]
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                raise
+            state = "deleted"
+        if state not in ["merged", "closed", "deleted"]:
+            continue
+        if branch in checked_out:
+            logging.info("Skipping " + branch + " (" + state + "), it is"
+                         " checked out")
+            continue
+        logging.info("Delete branch " + branch + " (" + state + ")")
+        branches_stale += [branch]
+
+    # Find remotes that are not used by any remaining branch
+    remotes_used = set()
+    for branch, remote in branch_remotes.items():
+        if branch not in branches_stale:
+            remotes_used.add(remote)
+    remotes_stale = set()
+    remotes_existing = git.remotes()
+    for branch in branches_stale:
+        remote = branch_remotes[branch]
+        if (remote and remote != "origin" and remote not in remotes_used and
+                remote in remotes_existing):
+            remotes_stale.add(remote)
+
+    # Count refs that go away with the remotes
+    refs = len(branches_stale)
+    for ref in git.branches("refs/remotes"):
+        if ref.split("/", 1)[0] in remotes_stale:
+            refs += 1
+    for remote in sorted(remotes_stale):
+        logging.info("Delete remote " + remote)
+
+    # mrdb entries of deleted branches, or of branches deleted manually
+    db = mrdb.load()
+    entries = db.get(origin["host"], {}).get(origin["project_id"], {})
+    mrdb_stale = [branch for branch in entries.keys()
+                  if branch in branches_stale or branch not in branch_remotes]
+
+    if not dry_run:
+        # One git process, which also removes the branch.* config sections
+        if branches_stale:
+            git.run(["branch", "-D"] + branches_stale)
+        for remote in remotes_stale:
+            git.run(["remote", "remove", remote])
+        mrdb.remove(origin["host"], origin["project_id"], mrdb_stale)
+
+    return {"branches": len(branches_stale),
+            "remotes": len(remotes_stale),
+            "refs": refs,
+            "mrdb": len(mrdb_stale)}
+
+
+def prefetch():
+    """ Refresh the API cache for all open MRs and fetch their commits into
+        hidden refs (see ref_prefetch()), together with the target branches
+        from origin. A following checkout of a prefetched MR then only needs
+        to update local refs, unless the MR has changed in the meantime.
+
+        :returns: list of prefetched MR IDs """
+    origin = gitlab.parse_git_origin()
+    url_mrs = "/projects/{}/merge_requests?state=opened".format(
+        origin["api_project_id"])
+    mrs = gitlab.download_json_pages(url_mrs, revalidate=True)
+
+    refspecs = []
+    target_branches = set()
+    mr_ids = []
+    for api_mr in mrs:
+        mr_id = api_mr["iid"]
+        try:
+            get_status(mr_id, revalidate=True)
+        except (MrhlprError, urllib.error.HTTPError) as e:
+            logging.warning(f"Skipping MR {mr_id}: {e}")
+            continue
+        mr_ids += [mr_id]
+        target_branches.add(api_mr["target_branch"])
+        refspecs += [f"+refs/merge-requests/{mr_id}/head:"
+                     f"{ref_prefetch(mr_id)}"]
+    for branch in sorted(target_branches):
+        refspecs += [f"+refs/heads/{branch}:refs/remotes/origin/{branch}"]
+
+    if refspecs:
+        logging.info("Fetch " + git.get_remote_url() + " (" +
+                     str(len(mr_ids)) + " MRs)")
+        git.run(["fetch", "--no-tags", "origin"] + refspecs)
+
+    # Delete refs of MRs that are not open anymore
+    refs_stale = []
+    for ref in git.branches("refs/mrhlpr/prefetch"):
+        mr_id = ref.rsplit("/", 1)[1]
+        if not mr_id.isdigit() or int(mr_id) not in mr_ids:
+            refs_stale += ["delete " + ref_prefetch(mr_id)]
+    git.update_refs(refs_stale)
+
+    return mr_ids
+
+
+def prefetch_background():
+    """ Run 'mrhlpr prefetch' detached from the current process, with its
+        output discarded. """
+    script = os.path.realpath(os.path.realpath(__file__) + "/../../mrhlpr.py")
+    subprocess.Popen([sys.executable, script, "prefetch"],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
@@ -2,10 +2,14 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 """ Simple lookup table on disk for local (host, project, branch) to MR ID. """
 
+import copy
 import json
 import os
 import logging
 
+# Parsed database with (mtime, size) of the file, see load()
+loaded = {"key": None, "db": {}}
+
 
 def load():
     """ :returns: dict of the loaded lookup table, looks like:
@@ -16,8 +20,15 @@ def load():
     path = os.getenv("HOME") + "/.cache/mrhlpr/mrdb.json"
     if not os.path.exists(path):
         return {}
-    with open(path, "r") as handle:
-        return json.load(handle)
+
+    # Only parse again if the file changed (relevant for daemon.py)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if loaded["key"] != key:
+        with open(path, "r") as handle:
+            loaded["db"] = json.load(handle)
+        loaded["key"] = key
+    return copy.deepcopy(loaded["db"])
 
 
 def get(host, project_id, branch):
@@ -55,3 +66,27 @@ def set(host, project_id, branch, mr_id):
     db[host][project_id][branch] = mr_id
     with open(path, "w") as handle:
         handle.write(json.dumps(db, indent=4))
+
+
+def remove(host, project_id, branches):
+    """ Remove the given branches of host, project_id from the database.
+
+        :param branches: list of local branch names
+        :returns: number of removed entries """
+    path = os.getenv("HOME") + "/.cache/mrhlpr/mrdb.json"
+    db = load()
+    if host not in db or project_id not in db[host]:
+        return 0
+
+    removed = 0
+    for branch in branches:
+        if branch in db[host][project_id]:
+            logging.debug(str([host, project_id, branch]) + " removed")
+            del db[host][project_id][branch]
+            removed += 1
+    if not removed:
+        return 0
+
+    with open(path, "w") as handle:
+        handle.write(json.dumps(db, indent=4))
+    return removed
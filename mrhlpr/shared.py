@@ -0,0 +1,92 @@
+# Copyright 2020 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+""" Bare repository that caches fork objects for multiple local clones.
+
+    Enable with 'git config --global mrhlpr.sharedCache true'. Fork branches
+    get fetched into the shared repository once, and clones use its objects
+    through objects/info/alternates instead of storing their own copy. The
+    shared repository must therefore never prune objects, so gc is configured
+    accordingly. """
+
+import logging
+import os
+
+from . import git
+
+
+def path():
+    """ :returns: path to the shared bare repository """
+    return os.getenv("HOME") + "/.cache/mrhlpr/shared.git"
+
+
+def enabled():
+    """ :returns: True if the shared cache is enabled in the git config """
+    return git.config_enabled("mrhlpr.sharedCache")
+
+
+def init():
+    """ Create the shared repository if it does not exist yet, and add it to
+        the alternates of the current clone. """
+    shared = path()
+    if not os.path.exists(shared):
+        os.makedirs(os.path.dirname(shared), exist_ok=True)
+        git.run(["init", "-q", "--bare", shared])
+        git.run(["--git-dir", shared, "config", "gc.auto", "0"])
+        git.run(["--git-dir", shared, "config", "gc.pruneExpire", "never"])
+
+    objects = os.path.join(shared, "objects")
+    alternates = git.run(["rev-parse", "--git-path",
+                          "objects/info/alternates"])
+    existing = []
+    if os.path.exists(alternates):
+        with open(alternates, "r") as handle:
+            existing = handle.read().splitlines()
+    if objects in existing:
+        return
+
+    logging.info("Using objects from shared cache: " + shared)
+    os.makedirs(os.path.dirname(alternates), exist_ok=True)
+    with open(alternates, "a") as handle:
+        handle.write(objects + "\n")
+
+
+def seed(project_id, target_branch):
+    """ Copy the target branch from the current clone into the shared
+        repository (without network access), so fetching a fork branch on top
+        of it only transfers the fork's own commits. This stores the upstream
+        history in the shared repository once.
+
+        :param project_id: origin project, e.g. "postmarketOS/pmaports"
+        :param target_branch: branch in origin that the MR targets """
+    ref_local = "refs/remotes/origin/" + target_branch
+    if git.run(["rev-parse", "-q", "--verify", ref_local],
+               check=False) is None:
+        return
+    git_dir = os.path.abspath(git.run(["rev-parse", "--git-common-dir"]))
+    git.run(["--git-dir", path(), "fetch", "--no-tags", git_dir,
+             "+" + ref_local + ":refs/upstream/" + project_id + "/" +
+             target_branch])
+
+
+def fetch(url, source, branch, remote_local, project_id, target_branch):
+    """ Fetch a branch of a fork into the shared repository, then update the
+        remote-tracking branch of the current clone from there. The second
+        fetch does not copy any objects, they are available through the
+        alternates already.
+
+        :param url: fetch URL of the fork
+        :param source: fork project, e.g. "ollieparanoid/pmaports"
+        :param branch: branch in the fork
+        :param remote_local: name of the fork's remote in the current clone
+        :param project_id: origin project, see seed()
+        :param target_branch: branch in origin that the MR targets """
+    init()
+    seed(project_id, target_branch)
+    shared = path()
+    ref = "refs/forks/" + source + "/" + branch
+
+    logging.info("Fetch " + url + " (shared cache)")
+    git.run(["--git-dir", shared, "fetch", "--no-tags", url,
+             "+refs/heads/" + branch + ":" + ref])
+    git.run(["fetch", "--no-tags", shared,
+             "+" + ref + ":refs/remotes/" + remote_local + "/" + branch])